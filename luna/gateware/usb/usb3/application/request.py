@@ -0,0 +1,527 @@
+#
+# This file is part of LUNA.
+#
+# Copyright (c) 2020 Great Scott Gadgets <info@greatscottgadgets.com>
+# SPDX-License-Identifier: BSD-3-Clause
+""" SuperSpeed request handling gateware. """
+
+import functools
+import operator
+
+from amaranth            import *
+from amaranth.hdl.rec    import Record, DIR_FANOUT
+from amaranth.lib.coding import Encoder
+
+from ...request       import SetupPacket
+from ...stream        import SuperSpeedStreamInterface
+from ....utils        import falling_edge_detected
+
+
+class DataHeaderPacket(Record):
+    """ Record carrying the subset of a Data Packet Header relevant to request handling.
+
+    Components (O = output from our header parser; read-only input to others):
+        O: setup              -- High if the associated data packet carries a setup request.
+        O: sequence_number[5] -- The sequence number of the associated data packet.
+        O: data_length[16]    -- The length of the associated data packet, in bytes.
+    """
+
+    def __init__(self):
+        super().__init__([
+            ('setup',            1, DIR_FANOUT),
+            ('sequence_number',  5, DIR_FANOUT),
+            ('data_length',     16, DIR_FANOUT),
+        ])
+
+
+class HandshakeGeneratorInterface(Record):
+    """ Record representing a request to our transaction-layer handshake generator.
+
+    Components (I = input to the handshake generator):
+        I: send_ack         -- Strobe; requests generation of an ACK transaction packet.
+        I: send_stall       -- Strobe; requests generation of a STALL transaction packet.
+        I: retry_required   -- High if any generated ACK should have its Retry bit set.
+        I: next_sequence[5] -- The sequence number to be included in any generated ACK.
+    """
+
+    def __init__(self):
+        super().__init__([
+            ('send_ack',        1, DIR_FANOUT),
+            ('send_stall',      1, DIR_FANOUT),
+            ('retry_required',  1, DIR_FANOUT),
+            ('next_sequence',   5, DIR_FANOUT),
+        ])
+
+
+class HandshakeReceiverInterface(Record):
+    """ Record representing handshakes detected by our transaction-layer receiver.
+
+    Components (O = output from the handshake receiver):
+        O: ack_received    -- Strobe; indicates that an ACK transaction packet was received.
+        O: retry_received  -- Strobe; indicates that an ACK with its Retry bit set was received.
+        O: status_received -- Strobe; indicates that a STATUS transaction packet was received.
+    """
+
+    def __init__(self):
+        super().__init__([
+            ('ack_received',     1, DIR_FANOUT),
+            ('retry_received',   1, DIR_FANOUT),
+            ('status_received',  1, DIR_FANOUT),
+        ])
+
+
+class SuperSpeedRequestHandlerInterface:
+    """ Interface representing a connection between a control endpoint and a request handler.
+
+    Attributes
+    ----------
+    setup: SetupPacket(), input to request handler
+        Carries the most recent setup request to the handler.
+
+    data_requested: Signal(), input to request handler
+        Strobe; indicates that an IN token was received, and the handler should respond with data.
+    status_requested: Signal(), input to request handler
+        Strobe; indicates that the status stage has begun, and the handler should respond with a handshake.
+
+    rx: SuperSpeedStreamInterface(), input stream to request handler
+        The receive stream for any data packets received; broadcast to handlers as a read-only view.
+    rx_header: DataHeaderPacket(), input to request handler
+        The header associated with the packet currently on :attr:``rx``.
+    rx_complete: Signal(), input to request handler
+        Strobe; indicates that the most recent packet received passed its checks, and can be used.
+    rx_invalid: Signal(), input to request handler
+        Strobe; indicates that the most recent packet received was corrupted, and should be discarded.
+    data_received: Signal(), input to request handler
+        Strobe; indicates that a data packet has just finished arriving on :attr:``rx``.
+
+    tx: SuperSpeedStreamInterface(), output stream from request handler
+        The transmit stream for any data packets generated by the handler.
+    tx_length: Signal(range(MAX_PACKET_SIZE + 1)), output from request handler
+        The length of the packet to be transmitted; used for header generation.
+    tx_sequence_number: Signal(5), output from request handler
+        The sequence number associated with any packet being transmitted.
+
+    handshakes_out: HandshakeGeneratorInterface(), output from request handler
+        Carries handshake generation requests.
+    handshakes_in: HandshakeReceiverInterface(), input to request handler
+        Indicates when handshakes are detected from the host.
+
+    address_changed: Signal(), output from request handler
+        Strobe; pulses high when the device's address should be changed.
+    new_address: Signal(7), output from request handler
+        When :attr:``address_changed`` is high, carries the address that should be adopted.
+
+    active_config: Signal(8), input to request handler
+        The configuration number of the active configuration.
+    config_changed: Signal(), output from request handler
+        Strobe; pulses high when the device's configuration should be changed.
+    new_config: Signal(8), output from request handler
+        When :attr:``config_changed`` is high, carries the configuration that should be applied.
+    """
+
+    MAX_PACKET_SIZE = 512
+
+    def __init__(self):
+        self.setup              = SetupPacket()
+
+        self.data_requested     = Signal()
+        self.status_requested   = Signal()
+
+        self.rx                 = SuperSpeedStreamInterface()
+        self.rx_header          = DataHeaderPacket()
+        self.rx_complete        = Signal()
+        self.rx_invalid         = Signal()
+        self.data_received      = Signal()
+
+        self.tx                 = SuperSpeedStreamInterface()
+        self.tx_length          = Signal(range(self.MAX_PACKET_SIZE + 1))
+        self.tx_sequence_number = Signal(5)
+
+        self.handshakes_out     = HandshakeGeneratorInterface()
+        self.handshakes_in      = HandshakeReceiverInterface()
+
+        self.address_changed    = Signal()
+        self.new_address        = Signal(7)
+
+        self.active_config      = Signal(8)
+        self.config_changed     = Signal()
+        self.new_config         = Signal(8)
+
+
+
+class SuperSpeedSetupDecoder(Elaboratable):
+    """ Gateware that decodes any received setup packets.
+
+    Attributes
+    -----------
+    sink: SuperSpeedStreamInterface(), input stream [monitor only]
+        The receive stream to monitor for setup packets.
+
+    rx_good: Signal(), input
+        Strobe; indicates that the packet currently being received passed its checks.
+    rx_bad: Signal(), input
+        Strobe; indicates that the packet currently being received was corrupted.
+
+    header_in: DataHeaderPacket(), input
+        The header associated with the packet currently being received.
+
+    packet: SetupPacket(), output
+        The parsed contents of our setup packet, along with a ``received`` strobe.
+    """
+
+    def __init__(self):
+
+        #
+        # I/O port
+        #
+        self.sink      = SuperSpeedStreamInterface()
+
+        self.rx_good   = Signal()
+        self.rx_bad    = Signal()
+
+        self.header_in = DataHeaderPacket()
+
+        self.packet    = SetupPacket()
+
+
+    def elaborate(self, platform):
+        m = Module()
+        sink = self.sink
+
+        # Cache for our setup packet's contents; until we know the packet is valid.
+        # Keeping the two words as separate registers gives each capture a clean,
+        # full-word write enable, rather than a mux over the packed record.
+        words = Array(Signal(32, name=f"word{i}") for i in range(2))
+
+        # Keep our "new packet received" strobe de-asserted unless asserted below.
+        m.d.ss += self.packet.received.eq(0)
+
+        # Reduce our sink's valid bits once, so the same AND-reduction isn't rebuilt in
+        # each state that examines it.
+        all_valid = Signal()
+        m.d.comb += all_valid.eq(sink.valid.all())
+
+        # Precompute our "setup packet is starting" condition, so the valid-reduction and
+        # header check resolve outside of our FSM's next-state logic. This can't be
+        # registered, as the header and first data word arrive in the same cycle.
+        start_setup = Signal()
+        m.d.comb += start_setup.eq(all_valid & sink.first & self.header_in.setup)
+
+        with m.FSM(domain="ss") as fsm:
+
+            # WAIT_FOR_FIRST -- we're waiting for the first word of a setup packet.
+            with m.State("WAIT_FOR_FIRST"):
+
+                # Once we see the first word of a setup packet, capture it, and move on.
+                with m.If(start_setup):
+                    m.d.ss += words[0].eq(sink.data)
+                    m.next = "PARSE_SECOND"
+
+
+            # PARSE_SECOND -- we're waiting for the second word of a setup packet.
+            with m.State("PARSE_SECOND"):
+                with m.If(all_valid):
+
+                    # If this is the last word of our packet, as we expect, capture it...
+                    with m.If(sink.last):
+                        m.d.ss += words[1].eq(sink.data)
+
+                        # If the link layer resolves the packet's validity in this same
+                        # beat, act on it immediately -- saving a cycle of latency and
+                        # skipping WAIT_FOR_VALID entirely. Note that the second word
+                        # comes straight from the sink here, as our capture register
+                        # doesn't hold it until next cycle.
+                        with m.If(self.rx_good):
+                            m.d.ss += [
+                                self.packet.word_select(0, 32)  .eq(words[0]),
+                                self.packet.word_select(1, 32)  .eq(sink.data),
+                                self.packet.received            .eq(1),
+                            ]
+                            m.next = "WAIT_FOR_FIRST"
+                        with m.Elif(self.rx_bad):
+                            m.next = "WAIT_FOR_FIRST"
+
+                        # Otherwise, we'll wait for the link layer's verdict.
+                        with m.Else():
+                            m.next = "WAIT_FOR_VALID"
+
+                    # ... otherwise, this packet is too long to be a setup packet; ignore it.
+                    with m.Else():
+                        m.next = "WAIT_FOR_FIRST"
+
+
+            # WAIT_FOR_VALID -- we've captured a full setup packet, and now are waiting
+            # for the link layer to tell us whether it was received correctly.
+            with m.State("WAIT_FOR_VALID"):
+
+                # If our packet was received correctly, pass its contents along.
+                with m.If(self.rx_good):
+                    m.d.ss += [
+                        self.packet.word_select(0, 32)  .eq(words[0]),
+                        self.packet.word_select(1, 32)  .eq(words[1]),
+                        self.packet.received            .eq(1),
+                    ]
+                    m.next = "WAIT_FOR_FIRST"
+
+                # If it was corrupted, discard it.
+                with m.If(self.rx_bad):
+                    m.next = "WAIT_FOR_FIRST"
+
+        # Request one-hot encoding for our state register; the ``ss`` domain runs fast
+        # enough that we want the shallowest next-state logic our toolchain can give us.
+        # "safe" additionally asks the toolchain to emit recovery logic, so a multi-bit
+        # upset that lands us in an unreachable encoding returns us to our reset state
+        # instead of wedging the setup decoder until the next bus reset.
+        fsm.state.attrs["fsm_encoding"] = "one_hot"
+        fsm.state.attrs["syn_encoding"] = "safe,onehot"
+
+        return m
+
+
+
+class SuperSpeedRequestHandlerMultiplexer(Elaboratable):
+    """ Multiplexes multiple SuperSpeed request handlers down to a single interface.
+
+    Interfaces are added using .add_interface().
+
+    I/O port:
+        *: shared -- The post-multiplexer request handler interface.
+    """
+
+    def __init__(self):
+
+        #
+        # I/O port
+        #
+        self.shared = SuperSpeedRequestHandlerInterface()
+
+        #
+        # Internals
+        #
+        self._interfaces = []
+
+
+    def add_interface(self, interface: SuperSpeedRequestHandlerInterface):
+        """ Adds a SuperSpeedRequestHandlerInterface to the multiplexer.
+
+        Arbitration is not performed; it's expected only one handler will be
+        driving requests at a time.
+        """
+        self._interfaces.append(interface)
+
+
+    def _multiplex_signals(self, m, *, when, multiplex, sub_bus=None):
+        """ Helper that multiplexes a collection of mutually-exclusive interface signals.
+
+        Parameters:
+            when      -- The name of the interface signal that indicates that the `multiplex` signals
+                         should be selected for output. If this signal should be multiplexed, it
+                         should be included in `multiplex`.
+            multiplex -- The names of the interface signals to be multiplexed.
+        """
+
+        def get_signal(interface, name):
+            """ Fetches an interface signal by name / sub_bus. """
+
+            if sub_bus:
+                bus = getattr(interface, sub_bus)
+                return getattr(bus, name)
+            else:
+                return  getattr(interface, name)
+
+
+        # Only one interface should be driving at a time; so rather than building an
+        # if/elif priority cascade, OR together each interface's signals masked with
+        # its selection condition. This maps to a balanced tree, rather than a chain.
+        for signal_name in multiplex:
+            target_signal = get_signal(self.shared, signal_name)
+
+            sources = (
+                Mux(get_signal(interface, when), get_signal(interface, signal_name), 0)
+                for interface in self._interfaces
+            )
+            m.d.comb += target_signal.eq(functools.reduce(operator.or_, sources, 0))
+
+
+    def elaborate(self, platform):
+        m = Module()
+        shared = self.shared
+
+        # Detect the end of any data packets received, once; each pre-mux handler sees
+        # the same receive stream, so there's no need for them to each carry their own
+        # edge detector.
+        m.d.comb += shared.data_received.eq(falling_edge_detected(m, shared.rx.valid, domain="ss"))
+
+        #
+        # Pass through signals being routed -to- our pre-mux interfaces.
+        #
+        for interface in self._interfaces:
+            m.d.comb += [
+                shared.setup               .connect(interface.setup),
+
+                interface.data_requested   .eq(shared.data_requested),
+                interface.status_requested .eq(shared.status_requested),
+
+                interface.rx               .tap(shared.rx),
+                interface.rx_header        .eq(shared.rx_header),
+                interface.rx_complete      .eq(shared.rx_complete),
+                interface.rx_invalid       .eq(shared.rx_invalid),
+                interface.data_received    .eq(shared.data_received),
+
+                interface.active_config    .eq(shared.active_config),
+                shared.handshakes_in       .connect(interface.handshakes_in),
+            ]
+
+        #
+        # Multiplex the signals being routed -from- our pre-mux interfaces.
+        #
+        self._multiplex_signals(m,
+            when='address_changed',
+            multiplex=['address_changed', 'new_address']
+        )
+
+        self._multiplex_signals(m,
+            when='config_changed',
+            multiplex=['config_changed', 'new_config']
+        )
+
+        #
+        # Connect up our transmit interface.
+        #
+
+        # Only one handler transmits at a time; isolate the least-significant active
+        # transmitter into a one-hot grant, so each of our wide tx fields resolves
+        # through a single layer of muxing rather than a priority chain.
+        tx_requests = Cat(interface.tx.valid.any() for interface in self._interfaces)
+        tx_grant    = Signal(len(self._interfaces))
+        m.d.comb += tx_grant.eq(tx_requests & -tx_requests)
+
+        # Encode our grant into an index...
+        m.submodules.tx_encoder = tx_encoder = Encoder(len(self._interfaces))
+        m.d.comb += tx_encoder.i.eq(tx_grant)
+
+        # ... and gather each transmit field across our interfaces, so every shared
+        # field below becomes a single indexed mux over one collection.
+        tx_valids    = Array(interface.tx.valid           for interface in self._interfaces)
+        tx_firsts    = Array(interface.tx.first           for interface in self._interfaces)
+        tx_lasts     = Array(interface.tx.last            for interface in self._interfaces)
+        tx_datas     = Array(interface.tx.data            for interface in self._interfaces)
+        tx_lengths   = Array(interface.tx_length          for interface in self._interfaces)
+        tx_sequences = Array(interface.tx_sequence_number for interface in self._interfaces)
+
+        # Stage carrying the muxed transmit fields, ahead of our output register.
+        tx_selected          = SuperSpeedStreamInterface()
+        tx_length_selected   = Signal.like(shared.tx_length)
+        tx_sequence_selected = Signal.like(shared.tx_sequence_number)
+
+        with m.If(~tx_encoder.n):
+            m.d.comb += [
+                tx_selected.valid          .eq(tx_valids[tx_encoder.o]),
+                tx_selected.first          .eq(tx_firsts[tx_encoder.o]),
+                tx_selected.last           .eq(tx_lasts[tx_encoder.o]),
+                tx_selected.data           .eq(tx_datas[tx_encoder.o]),
+                tx_length_selected         .eq(tx_lengths[tx_encoder.o]),
+                tx_sequence_selected       .eq(tx_sequences[tx_encoder.o]),
+            ]
+
+        # Buffer the muxed stream to improve timings; this terminates the selection
+        # network in a register, rather than letting it feed downstream logic directly.
+        with m.If(~shared.tx.valid.any() | shared.tx.ready):
+            m.d.ss += [
+                shared.tx                  .stream_eq(tx_selected, omit={'ready'}),
+                shared.tx_length           .eq(tx_length_selected),
+                shared.tx_sequence_number  .eq(tx_sequence_selected),
+            ]
+            m.d.comb += tx_selected.ready.eq(1)
+
+        # Fan our transmit handshake back out to whichever interface holds the grant.
+        for index, interface in enumerate(self._interfaces):
+            m.d.comb += interface.tx.ready.eq(tx_selected.ready & tx_grant[index])
+
+        #
+        # Connect up our handshake-generator interface.
+        #
+
+        # As with transmit, grant the least-significant interface requesting a
+        # handshake, and select its fields through a single indexed mux apiece,
+        # rather than a priority chain over the whole handshake bus.
+        handshake_requests = Cat(
+            interface.handshakes_out.send_ack | interface.handshakes_out.send_stall
+            for interface in self._interfaces
+        )
+        handshake_grant = Signal(len(self._interfaces))
+        m.d.comb += handshake_grant.eq(handshake_requests & -handshake_requests)
+
+        m.submodules.handshake_encoder = handshake_encoder = Encoder(len(self._interfaces))
+        m.d.comb += handshake_encoder.i.eq(handshake_grant)
+
+        send_acks       = Array(interface.handshakes_out.send_ack       for interface in self._interfaces)
+        send_stalls     = Array(interface.handshakes_out.send_stall     for interface in self._interfaces)
+        retry_requireds = Array(interface.handshakes_out.retry_required for interface in self._interfaces)
+        next_sequences  = Array(interface.handshakes_out.next_sequence  for interface in self._interfaces)
+
+        with m.If(~handshake_encoder.n):
+            m.d.comb += [
+                shared.handshakes_out.send_ack        .eq(send_acks[handshake_encoder.o]),
+                shared.handshakes_out.send_stall      .eq(send_stalls[handshake_encoder.o]),
+                shared.handshakes_out.retry_required  .eq(retry_requireds[handshake_encoder.o]),
+                shared.handshakes_out.next_sequence   .eq(next_sequences[handshake_encoder.o]),
+            ]
+
+        return m
+
+
+
+class StallOnlyRequestHandler(Elaboratable):
+    """ Simple gateware request handler that only conditionally stalls requests.
+
+    I/O port:
+        *: interface -- The SuperSpeedRequestHandlerInterface used to handle requests.
+                        See its record definition for signal definitions.
+    """
+
+    def __init__(self, stall_condition=None):
+        """
+        Parameters:
+            stall_condition -- A function that accepts a SetupPacket, and returns
+                               an Amaranth conditional indicating whether we should stall.
+        """
+
+        self.condition = stall_condition or (lambda _: 1)
+
+        #
+        # I/O port
+        #
+        self.interface = SuperSpeedRequestHandlerInterface()
+
+
+    def elaborate(self, platform):
+        m = Module()
+        interface = self.interface
+
+        # Evaluate our stall condition up front; if it turns out to be a compile-time
+        # constant -- as with the default "stall everything" handler -- we can
+        # specialize, rather than gating on a condition that never changes.
+        condition = self.condition(interface.setup)
+        if isinstance(condition, (bool, int)):
+            condition = Const(condition)
+
+        stall_opportunity = \
+            interface.data_requested | interface.status_requested | interface.data_received
+
+        # For constant conditions, stall on every opportunity (or never); no gating needed.
+        if isinstance(condition, Const):
+            if condition.value:
+                m.d.comb += interface.handshakes_out.send_stall.eq(stall_opportunity)
+
+        else:
+            # If we have an opportunity to stall...
+            with m.If(stall_opportunity):
+
+                # ... and our stall condition is met ...
+                with m.If(condition):
+
+                    # ... do so.
+                    m.d.comb += interface.handshakes_out.send_stall.eq(1)
+
+        return m